@@ -1,47 +1,266 @@
 # back.py
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import Annotated, Literal
+from typing_extensions import TypedDict  # pydantic 在 Python < 3.12 需要 typing_extensions 版
 import os
 import time
+import hashlib
+import asyncio
 import logging
+from collections import deque
 
-from openai import OpenAI
+import httpx
+import orjson
+import tiktoken
+from cachetools import LRUCache, TTLCache
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI
+
+try:
+    import redis.asyncio as aioredis
+    from redis.exceptions import ConnectionError as RedisConnectionError
+    from redis.exceptions import TimeoutError as RedisTimeoutError
+except ImportError:  # 沒裝 redis 就只用本機限流
+    aioredis = None
+
+logger = logging.getLogger(__name__)
 
 # ---- config ----
 MODEL = os.getenv("MODEL_NAME", "gpt-4o-mini")
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "500"))
+# 前端可用 max_tokens 要求較短的回覆，會被夾在 [MIN_TOKENS, MAX_TOKENS]
+MIN_TOKENS = 50
+# 最後一則 user 訊息少於 SHORT_QUERY_CHARS 字時改用 SHORT_QUERY_MAX_TOKENS；0 表示關閉
+SHORT_QUERY_CHARS = int(os.getenv("SHORT_QUERY_CHARS", "0"))
+SHORT_QUERY_MAX_TOKENS = int(os.getenv("SHORT_QUERY_MAX_TOKENS", "120"))
+# 出現任一字串就結束回覆（不含該字串）；system prompt 要求模型以 </END> 收尾
+STOP_SEQUENCES = ("</END>",)
 TEMPERATURE = float(os.getenv("TEMPERATURE", "0.3"))
+# 歷史訊息依 token 數截斷（由新到舊），不是固定則數
+HISTORY_TOKENS = int(os.getenv("HISTORY_TOKENS", "2000"))
+# 單則訊息字數上限，超過回 422
+MAX_MESSAGE_CHARS = int(os.getenv("MAX_MESSAGE_CHARS", "8000"))
+OPENAI_RETRIES = int(os.getenv("OPENAI_RETRIES", "5"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))
+# 含所有重試在內，單次 /chat 最多等多久
+TURN_TIMEOUT = float(os.getenv("TURN_TIMEOUT", "120"))
+# 同時打 OpenAI 的上限（每個 worker）
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "20"))
+
+# 系統提示：可用 SYSTEM_PROMPT_FILE 指定檔案，換 prompt 不必改程式
+DEFAULT_SYSTEM_PROMPT = (
+    "你是專業的台灣保險顧問 AI 助理，請使用繁體中文回答。"
+    "回覆格式：先用一句話點出重點，再條列最多 5 點說明，最後給出「下一步建議」。"
+    "不確定的資訊請直接說明，不要捏造保單條款、費率或數字。"
+    "回答完畢後輸出 </END>。"
+)
+SYSTEM_PROMPT_FILE = os.getenv("SYSTEM_PROMPT_FILE")
+if SYSTEM_PROMPT_FILE:
+    with open(SYSTEM_PROMPT_FILE, encoding="utf-8") as f:
+        SYSTEM_PROMPT = f.read().strip()
+else:
+    SYSTEM_PROMPT = DEFAULT_SYSTEM_PROMPT
+# prompt 第一行固定不變，import 時組好一次
+SYSTEM_PART = f"SYSTEM: {SYSTEM_PROMPT}\n"
+
+# 相同對話直接回快取，不再打 OpenAI；CACHE_SIZE=0 關閉
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", "2048"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "3600"))
+
+# 每個 IP 在 WINDOW_SECONDS 內最多 MAX_REQ 次（Redis：token bucket；本機：sliding window）
+WINDOW_SECONDS = float(os.getenv("RATE_WINDOW_SECONDS", "60"))
+MAX_REQ = int(os.getenv("RATE_MAX_REQ", "30"))
+# 多個 worker / 多台機器時設定 REDIS_URL，讓限流額度共用
+REDIS_URL = os.getenv("REDIS_URL")
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_PROJECT = os.getenv("OPENAI_PROJECT")  # 可為 None
 if not OPENAI_API_KEY:
     raise RuntimeError("Please set OPENAI_API_KEY as an environment variable")
 
+# 共用連線池：所有請求重用同一組 keep-alive 連線
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+)
+
 # 重要：gpt-4o-* 走 Responses API，且帶上 project
-client = OpenAI(api_key=OPENAI_API_KEY, project=OPENAI_PROJECT)
+client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    project=OPENAI_PROJECT,
+    # SDK 內建 exponential backoff，並會遵守 Retry-After
+    max_retries=OPENAI_RETRIES,
+    timeout=httpx.Timeout(connect=5.0, read=OPENAI_TIMEOUT, write=10.0, pool=5.0),
+    http_client=http_client,
+)
 
-app = FastAPI()
+# orjson：比 stdlib json 快，中文直接輸出 UTF-8 不做 \uXXXX 轉義
+app = FastAPI(default_response_class=ORJSONResponse)
 START_TS = time.time()
 
-# CORS：先全部放行方便測試
-allow_origins = os.getenv("CORS_ORIGINS", "*")
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=[o.strip() for o in allow_origins.split(",")] if allow_origins else ["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# ---------- CORS ----------
+class AllowAllCORSMiddleware:
+    """
+    CORS_ORIGINS=* 時使用：每個回應直接補三個 header，不逐一比對 origin
+    （萬用字元不能搭配 credentials，前端本來就沒帶 cookie）
+    """
+    HEADERS = [
+        (b"access-control-allow-origin", b"*"),
+        (b"access-control-allow-methods", b"*"),
+        (b"access-control-allow-headers", b"*"),
+    ]
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if scope["method"] == "OPTIONS" and any(
+            k == b"access-control-request-method" for k, _ in scope["headers"]
+        ):
+            # preflight 直接回 200，不進 app
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": self.HEADERS + [(b"access-control-max-age", b"600"), (b"content-length", b"0")],
+            })
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), *self.HEADERS]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+class OriginSetCORSMiddleware(CORSMiddleware):
+    """指定來源時使用：origin 比對改成 frozenset 查表"""
+
+    def __init__(self, app, allow_origins=(), **kwargs):
+        super().__init__(app, allow_origins=allow_origins, **kwargs)
+        self.origins_set = frozenset(allow_origins)
+
+    def is_allowed_origin(self, origin: str) -> bool:
+        return origin in self.origins_set
+
+# CORS：預設全部放行方便測試；啟動時解析一次
+CORS_ORIGINS = tuple(o.strip() for o in os.getenv("CORS_ORIGINS", "*").split(",") if o.strip())
+if not CORS_ORIGINS or "*" in CORS_ORIGINS:
+    CORS_ORIGINS = ("*",)
+    app.add_middleware(AllowAllCORSMiddleware)
+else:
+    app.add_middleware(
+        OriginSetCORSMiddleware,
+        allow_origins=CORS_ORIGINS,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+# ---------- Rate limit ----------
+# ip -> 最近 MAX_REQ 次請求時間（固定大小 ring）；Redis 不可用時的本機 fallback
+_bucket: dict[str, deque[float]] = {}
+_bucket_lock = asyncio.Lock()
+_REFILL_PER_SEC = MAX_REQ / WINDOW_SECONDS
+
+# KEYS[1]=rl:<ip>  ARGV={now_ms, rate/sec, capacity, cost, ttl_ms}
+# 一次 round trip 完成 refill + 扣 token，回傳 1 放行 / 0 拒絕
+_RATE_LUA = """
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local capacity = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local tokens = tonumber(b[1]) or capacity
+local ts = tonumber(b[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate / 1000)
+if tokens < cost then
+  return 0
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens - cost, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], ARGV[5])
+return 1
+"""
+
+if REDIS_URL and aioredis is not None:
+    _redis = aioredis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+    # register_script 走 EVALSHA，腳本不在 server 時自動 SCRIPT LOAD
+    _rate_script = _redis.register_script(_RATE_LUA)
+else:
+    _redis = None
+    _rate_script = None
+
+async def _rate(ip: str):
+    if _rate_script is not None:
+        try:
+            # 多台機器共用同一個 bucket，只能用 wall clock
+            allowed = await _rate_script(
+                keys=[f"rl:{ip}"],
+                args=[int(time.time() * 1000), _REFILL_PER_SEC, MAX_REQ, 1, int(WINDOW_SECONDS * 2000)],
+            )
+        except (RedisConnectionError, RedisTimeoutError):
+            # Redis 掛掉時 fail-open，改用本機 bucket
+            logger.warning("redis rate limit unavailable, using local bucket")
+        else:
+            if not allowed:
+                raise HTTPException(status_code=429, detail="Too many requests")
+            return
+    await _rate_local(ip)
+
+async def _rate_local(ip: str):
+    # monotonic：比 time.time() 便宜，且不受 NTP 調時影響
+    now = time.monotonic()
+    async with _bucket_lock:
+        dq = _bucket.setdefault(ip, deque(maxlen=MAX_REQ))
+        while dq and now - dq[0] >= WINDOW_SECONDS:
+            dq.popleft()
+        if len(dq) >= MAX_REQ:
+            raise HTTPException(status_code=429, detail="Too many requests")
+        dq.append(now)
+
+async def _sweep_buckets():
+    # 每 5 分鐘清掉閒置的 IP，避免 _bucket 無限成長
+    while True:
+        await asyncio.sleep(300)
+        now = time.monotonic()
+        async with _bucket_lock:
+            for ip, dq in list(_bucket.items()):
+                if not dq or now - dq[-1] > WINDOW_SECONDS * 5:
+                    del _bucket[ip]
 
 # ---------- Schemas ----------
-class ChatMessage(BaseModel):
-    role: str
-    content: str
+# TypedDict：FastAPI 照樣驗證欄位，但每則訊息只是 dict，不建 model instance
+class ChatMessage(TypedDict):
+    role: Literal["user", "system", "assistant"]
+    content: Annotated[str, Field(max_length=MAX_MESSAGE_CHARS)]
 
 class ChatRequest(BaseModel):
     messages: list[ChatMessage]
+    max_tokens: int | None = None
+
+# 只用於 OpenAPI 文件；handler 直接回 dict，不再經過 response_model 驗證一次
+class ChatResponse(BaseModel):
+    reply: str
+
+# ---------- Lifecycle ----------
+_sweeper: asyncio.Task | None = None
+
+@app.on_event("startup")
+async def on_startup():
+    global _sweeper
+    _sweeper = asyncio.create_task(_sweep_buckets())
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if _sweeper is not None:
+        _sweeper.cancel()
+    if _redis is not None:
+        await _redis.aclose()
+    await http_client.aclose()
 
 # ---------- Endpoints ----------
 @app.get("/health")
@@ -53,43 +272,293 @@ def version():
     return {
         "model": MODEL,
         "max_tokens": MAX_TOKENS,
-        "history_limit": 8,
-        "cors": [allow_origins] if isinstance(allow_origins, str) else allow_origins,
+        "history_tokens": HISTORY_TOKENS,
+        "cors": list(CORS_ORIGINS),
         "project_set": bool(OPENAI_PROJECT),
         "uptime_sec": int(time.time() - START_TS),
     }
 
-@app.post("/chat")
-def chat(req: ChatRequest):
+# ---------- Reply cache ----------
+# prompt hash -> 完整回覆；串流只在正常結束後才寫入
+_reply_cache: TTLCache | None = TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL) if CACHE_SIZE > 0 else None
+# 所有請求共用同一段 system prompt 前綴，讓 OpenAI 端 prompt cache 命中同一組機器
+_PROMPT_CACHE_KEY = hashlib.blake2b(SYSTEM_PART.encode(), digest_size=16).hexdigest()[:8]
+
+def _cache_key(prompt: str, max_tokens: int) -> str:
+    return hashlib.blake2b(f"{max_tokens}\n{prompt}".encode(), digest_size=16).hexdigest()
+
+def _cache_get(key: str) -> str | None:
+    return _reply_cache.get(key) if _reply_cache is not None else None
+
+def _cache_put(key: str, reply: str):
+    if _reply_cache is not None and reply:
+        _reply_cache[key] = reply
+
+# ---------- OpenAI calls ----------
+SEM = asyncio.Semaphore(OPENAI_CONCURRENCY)
+
+def _create(prompt: str, max_tokens: int, **kwargs):
+    return client.responses.create(
+        model=MODEL,
+        input=prompt,
+        max_output_tokens=max_tokens,
+        temperature=TEMPERATURE,
+        extra_body={"prompt_cache_key": _PROMPT_CACHE_KEY},
+        **kwargs,
+    )
+
+async def _call(prompt: str, max_tokens: int = MAX_TOKENS):
+    """非串流呼叫：受 SEM 限制；排隊等 SEM 的時間也算在 TURN_TIMEOUT 內"""
+    async def run():
+        async with SEM:
+            return await _create(prompt, max_tokens)
+
+    return await asyncio.wait_for(run(), timeout=TURN_TIMEOUT)
+
+def _retryable(e: BaseException) -> bool:
+    # 4xx 重送也一樣失敗；TimeoutError 是整輪已超過 TURN_TIMEOUT，不再加倍等待
+    if isinstance(e, APIStatusError):
+        return e.status_code == 429 or e.status_code >= 500
+    return isinstance(e, APIConnectionError)
+
+async def _call_many(prompts: list[str]) -> list:
+    """
+    一次送多個 prompt（例如彙整多段對話）：並行送出，總耗時約等於最慢的一次
+    可重試的失敗只個別重送一次，不整批重跑；仍失敗就把 exception 留在結果裡
+    """
+    results = await asyncio.gather(*(_call(p) for p in prompts), return_exceptions=True)
+    failed = [i for i, r in enumerate(results) if isinstance(r, Exception) and _retryable(r)]
+    if failed:
+        retried = await asyncio.gather(*(_call(prompts[i]) for i in failed), return_exceptions=True)
+        for i, r in zip(failed, retried):
+            results[i] = r
+    return results
+
+# ---------- Output length ----------
+# Responses API 沒有 stop 參數：串流時自己比對，命中就停止讀取並關閉上游
+_STOP_HOLD = max(map(len, STOP_SEQUENCES)) - 1
+
+def _max_tokens(req: ChatRequest) -> int:
+    if req.max_tokens is not None:
+        return min(MAX_TOKENS, max(MIN_TOKENS, req.max_tokens))
+    last = req.messages[-1] if req.messages else None
+    if SHORT_QUERY_CHARS and last and last["role"] == "user" and len(last["content"]) < SHORT_QUERY_CHARS:
+        return min(MAX_TOKENS, SHORT_QUERY_MAX_TOKENS)
+    return MAX_TOKENS
+
+def _find_stop(text: str, start: int = 0) -> int | None:
+    hits = [i for stop in STOP_SEQUENCES if (i := text.find(stop, start)) >= 0]
+    return min(hits) if hits else None
+
+def _cut_at_stop(text: str) -> str:
+    cut = _find_stop(text)
+    return text if cut is None else text[:cut]
+
+# ---------- History ----------
+try:
+    _enc = tiktoken.encoding_for_model(MODEL)
+except KeyError:  # tiktoken 還不認得的新模型
+    _enc = tiktoken.get_encoding("o200k_base")
+
+# content digest -> token 數；只存 digest，不在記憶體留下使用者原文
+_token_counts: LRUCache = LRUCache(maxsize=4096)
+
+def _count_tokens(content: str) -> int:
+    # 同一段對話每輪都會重送，舊訊息的 token 數直接查快取
+    key = hashlib.blake2b(content.encode(), digest_size=16).digest()
+    n = _token_counts.get(key)
+    if n is None:
+        n = _token_counts[key] = len(_enc.encode_ordinary(content))
+    return n
+
+def _trim_history(msgs: list[ChatMessage]) -> list[ChatMessage]:
+    """由新到舊累加 token，超過 HISTORY_TOKENS 就停；最新一則一定保留"""
+    total = 0
+    start = len(msgs)
+    while start > 0:
+        t = _count_tokens(msgs[start - 1]["content"])
+        if total + t > HISTORY_TOKENS and start < len(msgs):
+            break
+        total += t
+        start -= 1
+    return msgs[start:]
+
+# role -> prompt 前綴（含分隔），避免每則訊息 .upper() + f-string
+_ROLES = {"user": "USER: ", "system": "SYSTEM: ", "assistant": "ASSISTANT: "}
+
+def _build_prompt(req: ChatRequest) -> str:
+    # 將 messages 簡單串接（也可以自己定更好的格式）
+    msgs = _trim_history(req.messages)
+    # [SYSTEM_PART, 前綴, 內容, "\n", ..., "ASSISTANT:"] 一次 join
+    parts = [None] * (len(msgs) * 3 + 2)
+    parts[0] = SYSTEM_PART
+    i = 1
+    for m in msgs:
+        # role 已由 ChatMessage 的 Literal 驗證，直接查表
+        parts[i] = _ROLES[m["role"]]
+        parts[i + 1] = m["content"]
+        parts[i + 2] = "\n"
+        i += 3
+    parts[i] = "ASSISTANT:"
+    return "".join(parts)
+
+def _log_upstream_error(e: Exception):
+    # 只記錯誤類型與 status，不印 traceback / repr(e)（可能含使用者內容）
+    logger.error(
+        "openai_fail",
+        extra={"err_type": type(e).__name__, "status": getattr(e, "status_code", None)},
+    )
+
+def _upstream_error(e: Exception) -> ORJSONResponse:
+    # 錯誤打到 logs，前端回簡潔訊息
+    _log_upstream_error(e)
+    return ORJSONResponse(
+        status_code=502,
+        content={"detail": f"Upstream error: {str(e) or type(e).__name__}"},
+    )
+
+@app.post("/chat", responses={200: {"model": ChatResponse}})
+async def chat(req: ChatRequest, request: Request, response: Response):
     """
     使用 Responses API 呼叫 gpt-4o-mini
     把聊天訊息串成單一文字輸入（Demo 夠用）
     """
+    await _rate(request.client.host if request.client else "unknown")
+    prompt = _build_prompt(req)
+    max_tokens = _max_tokens(req)
+    key = _cache_key(prompt, max_tokens)
+    cached = _cache_get(key)
+    if cached is not None:
+        response.headers["X-Cache"] = "HIT"
+        return {"reply": cached}
     try:
-        # 將 messages 簡單串接（也可以自己定更好的格式）
-        parts = []
-        for m in req.messages:
-            r = m.role.strip().lower()
-            if r not in ("user", "system", "assistant"):
-                r = "user"
-            parts.append(f"{r.upper()}: {m.content}")
-        prompt = "\n".join(parts) + "\nASSISTANT:"
-
-        resp = client.responses.create(
-            model=MODEL,
-            input=prompt,
-            max_output_tokens=MAX_TOKENS,
-            temperature=TEMPERATURE,
-        )
+        resp = await _call(prompt, max_tokens)
         # 簡單取得輸出文字（OpenAI SDK 1.x 提供 output_text）
-        reply_text = resp.output_text
+        reply_text = _cut_at_stop(resp.output_text)
+        _cache_put(key, reply_text)
 
-        return {"reply": reply_text}
+        response.headers["X-Cache"] = "MISS"
+        return {"reply": reply_text or "（沒有產生內容）"}
 
     except Exception as e:
-        # 詳細錯誤打到 logs，前端回簡潔訊息
-        logging.exception("OpenAI upstream error")
-        return JSONResponse(
-            status_code=502,
-            content={"detail": f"Upstream error: {str(e)}"},
-        )
\ No newline at end of file
+        return _upstream_error(e)
+
+def _sse(event: str | None, data: str) -> str:
+    return (f"event: {event}\n" if event else "") + f"data: {data}\n\n"
+
+def _sse_delta(text: str) -> str:
+    return _sse(None, orjson.dumps({"delta": text}).decode())
+
+class _ReleasingStreamingResponse(StreamingResponse):
+    """
+    client 在 generator 開始前就斷線時，events() 的 finally 不會執行
+    回應結束後一定再呼叫一次 release，避免 SEM 名額外洩
+    """
+
+    def __init__(self, content, release, **kwargs):
+        super().__init__(content, **kwargs)
+        self.release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.release()
+
+@app.post("/chat/stream")
+async def chat_stream(req: ChatRequest, request: Request):
+    """
+    同 /chat，但以 SSE 逐字回傳：data: {"delta": "..."}，結束時送 event: done
+    第一個字就能先顯示，不必等整段生成完
+    """
+    await _rate(request.client.host if request.client else "unknown")
+    prompt = _build_prompt(req)
+    max_tokens = _max_tokens(req)
+    key = _cache_key(prompt, max_tokens)
+    cached = _cache_get(key)
+    if cached is not None:
+        async def replay():
+            yield _sse_delta(cached)
+            yield _sse("done", "[DONE]")
+
+        return StreamingResponse(
+            replay(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Cache": "HIT"},
+        )
+    # 整輪（排隊 + 開串流 + 讀完）共用同一個 deadline
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + TURN_TIMEOUT
+    try:
+        await asyncio.wait_for(SEM.acquire(), timeout=TURN_TIMEOUT)
+    except asyncio.TimeoutError as e:  # Python 3.10 的 asyncio.TimeoutError 不是內建 TimeoutError
+        return _upstream_error(e)
+    stream = None
+    released = False
+
+    async def release():
+        # SEM 名額要一直佔到串流讀完；可重複呼叫
+        nonlocal released
+        if released:
+            return
+        released = True
+        try:
+            if stream is not None:
+                await stream.close()
+        finally:
+            SEM.release()
+
+    try:
+        stream = await asyncio.wait_for(
+            _create(prompt, max_tokens, stream=True),
+            timeout=deadline - loop.time(),
+        )
+    except Exception as e:
+        await release()
+        return _upstream_error(e)
+    except BaseException:  # client 斷線導致 cancel 也要歸還名額
+        await release()
+        raise
+
+    async def events():
+        text = ""
+        sent = 0
+        it = stream.__aiter__()
+        try:
+            while True:
+                # deadline 只套在等上游下一個事件；yield 在外面，
+                # client 讀得慢（卡在 send）時不會被 cancel，仍能送出 error / done
+                event = await asyncio.wait_for(anext(it, None), timeout=deadline - loop.time())
+                if event is None:
+                    break
+                if event.type != "response.output_text.delta":
+                    continue
+                text += event.delta
+                cut = _find_stop(text, sent)
+                if cut is not None:
+                    # 命中 stop sequence：不再讀剩下的 token，close 會中斷上游生成
+                    text = text[:cut]
+                    break
+                # 尾巴可能是 stop sequence 的開頭，先留著等下一段
+                safe = len(text) - _STOP_HOLD
+                if safe > sent:
+                    yield _sse_delta(text[sent:safe])
+                    sent = safe
+        except Exception as e:
+            # 已開始串流就無法改 status code，改送 error 事件
+            _log_upstream_error(e)
+            yield _sse("error", orjson.dumps({"detail": f"Upstream error: {str(e) or type(e).__name__}"}).decode())
+            return
+        finally:
+            await release()
+        if len(text) > sent:
+            yield _sse_delta(text[sent:])
+        _cache_put(key, text)
+        yield _sse("done", "[DONE]")
+
+    return _ReleasingStreamingResponse(
+        events(),
+        release,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Cache": "MISS"},
+    )